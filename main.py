@@ -1,48 +1,70 @@
 import argparse
-import json
+import asyncio
+import hashlib
+import itertools
 import os
+import re
+import sqlite3
 import subprocess
 import tempfile
 import time
 import logging
-from transformers import pipeline
-import requests
+from collections import defaultdict
+import httpx
+import ijson
+import orjson
+from tenacity import retry, retry_if_exception, stop_after_attempt, wait_exponential_jitter
 
 # Configure logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
-try:
-    import git
-except ImportError:
-    logging.error("GitPython library not found. Install it using: pip install GitPython")
-    exit(1)
-
-# Load the model and measure loading time
-start_time = time.time()
-# try:
-#     # generator = pipeline("text2text-generation", model="Salesforce/codet5p-220m")
-#     generator = pipeline("text-generation", model="microsoft/phi-1_5")
-#     model_load_time = time.time() - start_time
-#     logging.info(f"Model loaded successfully in {model_load_time:.2f} seconds.")
-# except Exception as e:
-#     logging.error(f"Error loading model: {e}")
-#     exit(1)
-
-REMOTE_MODEL_URL = "http://192.168.1.13:9000/generate"
+REMOTE_BATCH_URL = "http://192.168.1.13:9000/generate_batch"
+REMOTE_WARMUP_URL = "http://192.168.1.13:9000/warmup"
+REMOTE_TIMEOUT = 300  # Generation on the hosted model can take a while
+BATCH_SIZE = 32  # Findings sent per /generate_batch request
+# Cap in-flight batch requests to what the Ollama backend serves in parallel
+MAX_CONCURRENT_REQUESTS = max(1, int(os.getenv("OLLAMA_NUM_PARALLEL", "4")))
+# Sent with every batch so suggestions do not silently change with the server's defaults
+GENERATION_SETTINGS = {"model": "llama2", "max_length": 200, "temperature": 0.7}
+CACHE_PATH = os.path.expanduser("~/.cache/patchpilot/llm_cache.db")
+CACHE_VERSION = 1  # Bump when prompts or stored suggestions change shape
+EMBEDDING_MODEL = "sentence-transformers/all-MiniLM-L6-v2"
+SEMANTIC_THRESHOLD = 0.92  # Minimum cosine similarity to reuse another finding's suggestion
+STREAM_PARSE_THRESHOLD = 32 * 1024 * 1024  # Reports larger than this are parsed incrementally
+MAX_ISSUE_TEXT_CHARS = 400  # Longer issue descriptions only add prefill cost to each prompt
+JSON_HEADERS = {"Content-Type": "application/json"}
+
+# Prompt templates, filled straight from a finding's own keys
+PROMPT_TMPL = (
+    "Given this security finding: {issue_text} in file {filename} at line {line_number}, "
+    "generate a concise and correct security fix. Keep the response under 100 words."
+)
+KEY_PROMPT_TMPL = (
+    "Given this security finding: {issue_text}, "
+    "generate a concise and correct security fix. Keep the response under 100 words."
+)
+NUMBER_RE = re.compile(r'\b\d+\b')
 
 def clone_repo(repo_url, temp_dir):
-    """Clones a Git repository into a temporary directory."""
+    """Shallow-clones the default branch of a Git repository into a temporary directory."""
     logging.info(f"Cloning repository: {repo_url} into {temp_dir}")
     try:
-        git.Repo.clone_from(repo_url, temp_dir)
+        # Scanning only needs the working tree, so skip history and unneeded blobs
+        subprocess.run(
+            ['git', 'clone', '--depth=1', '--filter=blob:none', '--single-branch', repo_url, temp_dir],
+            capture_output=True, text=True, check=True
+        )
         logging.info("Cloning successful.")
         return True
-    except git.GitCommandError as e:
-        logging.error(f"Error cloning repository: {e}")
+    except FileNotFoundError:
+        logging.error("Error: 'git' not found. Install it before running.")
+        return False
+    except subprocess.CalledProcessError as e:
+        logging.error(f"Error cloning repository: {e.stderr.strip()}")
         return False
 
-def run_sast_tool(tool_name, repo_path, output_file):
-    """Runs a SAST tool (Bandit or Semgrep) and returns results."""
+async def run_sast_tool(tool_name, repo_path, output_file):
+    """Runs a SAST tool (Bandit or Semgrep) and returns the path of its JSON report."""
     logging.info(f"Running {tool_name} on: {repo_path}")
     commands = {
         "bandit": ['bandit', '-r', repo_path, '-f', 'json', '-o', output_file],
@@ -53,91 +75,396 @@ def run_sast_tool(tool_name, repo_path, output_file):
         return None
     try:
         start_time = time.time()
-        subprocess.run(commands[tool_name], capture_output=True, text=True, check=False)
+        # Results go to output_file, so console output is discarded rather than buffered
+        proc = await asyncio.create_subprocess_exec(
+            *commands[tool_name], stdout=asyncio.subprocess.DEVNULL, stderr=asyncio.subprocess.DEVNULL
+        )
+        await proc.wait()
         elapsed_time = time.time() - start_time
         logging.info(f"{tool_name} scan completed in {elapsed_time:.2f} seconds.")
         if os.path.exists(output_file):
-            with open(output_file, 'r') as f:
-                return json.load(f)
+            return output_file
     except FileNotFoundError:
         logging.error(f"Error: '{tool_name}' not found. Install it before running.")
     except Exception as e:
         logging.error(f"Error running {tool_name}: {e}")
     return None
 
-# def get_llm_suggestion(finding):
-#     """Gets an LLM-generated secure code fix."""
-#     try:
-#         prompt = (
-#             f"Given this security finding: {finding.get('issue_text', 'N/A')} "
-#             f"in file {finding.get('filename', 'N/A')} at line {finding.get('line_number', 'N/A')}, "
-#             f"generate a concise and correct security fix. Keep the response under 100 words."
-#         )
-#         start_time = time.time()
-#         suggestions = generator(prompt, max_length=250, num_return_sequences=1)
-#         elapsed_time = time.time() - start_time
-#         logging.info(f"LLM suggestion generated in {elapsed_time:.2f} seconds.")
-#         return suggestions[0]['generated_text']
-#     except Exception as e:
-#         logging.error(f"Error getting LLM suggestion: {e}")
-#         return None
-
-def get_llm_suggestion(finding):
-    """Gets an LLM-generated secure code fix from the hosted model."""
+async def run_sast_tools(tool_names, repo_path, output_dir):
+    """Runs several SAST tools concurrently and returns (tool_name, report path) for each report produced."""
+    output_files = await asyncio.gather(*(
+        run_sast_tool(tool_name, repo_path, os.path.join(output_dir, f"{tool_name}_results.json"))
+        for tool_name in tool_names
+    ))
+    return [(tool_name, output_file) for tool_name, output_file in zip(tool_names, output_files) if output_file]
+
+async def warm_up_remote_model():
+    """Asks the model server to load its model so it is ready by the time the scan finishes."""
     try:
-        prompt = (
-            f"Given this security finding: {finding.get('issue_text', 'N/A')} "
-            f"in file {finding.get('filename', 'N/A')} at line {finding.get('line_number', 'N/A')}, "
-            f"generate a concise and correct security fix. Keep the response under 100 words."
-        )
+        async with httpx.AsyncClient(timeout=REMOTE_TIMEOUT) as client:
+            response = await client.post(REMOTE_WARMUP_URL)
+        if response.status_code == 200:
+            logging.info("Remote model warmed up.")
+        else:
+            logging.warning(f"Could not warm up remote model: {response.status_code}, {response.text}")
+    except httpx.HTTPError as e:
+        logging.warning(f"Could not warm up remote model: {e}")
+
+def normalize_semgrep_finding(finding):
+    """Maps a Semgrep result onto the Bandit field names the rest of the pipeline reads."""
+    extra = finding.get('extra', {})
+    return {
+        'test_id': finding.get('check_id', 'N/A'),
+        'issue_text': extra.get('message', 'N/A'),
+        'issue_severity': extra.get('severity', 'N/A'),
+        'filename': finding.get('path', 'N/A'),
+        'line_number': finding.get('start', {}).get('line', 'N/A'),
+    }
+
+def iter_findings(tool_name, output_file):
+    """Yields findings from a SAST JSON report, streaming large reports instead of loading them whole.
+
+    Semgrep findings are mapped to Bandit's field names so both tools share one pipeline.
+    """
+    try:
+        with open(output_file, 'rb') as f:
+            if os.path.getsize(output_file) > STREAM_PARSE_THRESHOLD:
+                findings = ijson.items(f, 'results.item')
+            else:
+                findings = orjson.loads(f.read()).get('results', [])
+            if tool_name == "semgrep":
+                findings = map(normalize_semgrep_finding, findings)
+            yield from findings
+    except (OSError, ijson.JSONError, orjson.JSONDecodeError) as e:
+        logging.error(f"Error parsing {output_file}: {e}")
+
+async def iter_in_thread(iterable):
+    """Iterates a blocking iterable in a worker thread, yielding its items on the event loop.
+
+    Keeps report parsing from holding the event loop, so batch requests go out while it runs.
+    """
+    loop = asyncio.get_running_loop()
+    queue = asyncio.Queue()
+    done = object()
+
+    def produce():
+        try:
+            for item in iterable:
+                loop.call_soon_threadsafe(queue.put_nowait, item)
+        finally:
+            loop.call_soon_threadsafe(queue.put_nowait, done)
+
+    producer = asyncio.create_task(asyncio.to_thread(produce))
+    while (item := await queue.get()) is not done:
+        yield item
+    await producer  # Re-raises anything the iterable raised
+
+class FindingFields:
+    """Read-only view of a finding for str.format_map, with 'N/A' for missing fields."""
+
+    def __init__(self, finding):
+        self.finding = finding
+
+    def __getitem__(self, key):
+        value = self.finding.get(key)
+        return 'N/A' if value is None else value
+
+def build_prompt(finding):
+    """Builds the fix-generation prompt for a single finding."""
+    return PROMPT_TMPL.format_map(FindingFields(finding))
+
+def cache_key_prompt(finding):
+    """Builds the location-independent prompt sent to the LLM and used as the cache key.
+
+    Filename and line number are left out and standalone numbers collapsed, so the same
+    rule firing across many files maps to a single prompt.
+    """
+    issue_text = NUMBER_RE.sub('N', (finding.get('issue_text') or 'N/A')[:MAX_ISSUE_TEXT_CHARS])
+    return KEY_PROMPT_TMPL.format(issue_text=issue_text)
+
+def strip_prompt_echo(text, prompt):
+    """Removes the prompt the model server echoes ahead of the generated text."""
+    if not text:
+        return None
+    if text.startswith(prompt):
+        text = text[len(prompt):]
+    return text.strip() or None
+
+def fill_location(suggestion, finding):
+    """Prefixes a location-independent suggestion with the finding's full prompt."""
+    return f"{build_prompt(finding)} {suggestion}" if suggestion else None
+
+class SuggestionCache:
+    """Persistent exact-match cache of LLM suggestions.
+
+    Keys hash the prompt together with the cache version and generation settings, so
+    changing the model or its settings starts from a clean slate instead of serving stale fixes.
+    """
+
+    def __init__(self, path=CACHE_PATH, settings=GENERATION_SETTINGS):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.conn = sqlite3.connect(path)
+        self.conn.execute("CREATE TABLE IF NOT EXISTS suggestions (key TEXT PRIMARY KEY, suggestion TEXT NOT NULL)")
+        self.namespace = orjson.dumps({"version": CACHE_VERSION, **settings}, option=orjson.OPT_SORT_KEYS)
+
+    def _key(self, prompt):
+        return hashlib.blake2b(self.namespace + b"\0" + prompt.encode()).hexdigest()
+
+    def get(self, prompt):
+        row = self.conn.execute("SELECT suggestion FROM suggestions WHERE key = ?", (self._key(prompt),)).fetchone()
+        return row[0] if row else None
+
+    def set_many(self, items):
+        """Stores (prompt, suggestion) pairs in a single transaction."""
+        with self.conn:
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO suggestions (key, suggestion) VALUES (?, ?)",
+                ((self._key(prompt), suggestion) for prompt, suggestion in items)
+            )
+
+    def close(self):
+        self.conn.close()
+
+class SemanticCache:
+    """In-memory cache matching prompts by embedding cosine similarity."""
+
+    def __init__(self, model_name=EMBEDDING_MODEL, threshold=SEMANTIC_THRESHOLD):
+        # Imported lazily: these pull in torch and are only needed with --semantic-cache
+        from sentence_transformers import SentenceTransformer
+        import faiss
 
         start_time = time.time()
-        response = requests.post(REMOTE_MODEL_URL, json={"prompt": prompt})
-        elapsed_time = time.time() - start_time
+        self.model = SentenceTransformer(model_name)
+        self.index = faiss.IndexFlatIP(self.model.get_sentence_embedding_dimension())
+        self.threshold = threshold
+        self.values = []
+        logging.info(f"Embedding model loaded in {time.time() - start_time:.2f} seconds.")
 
-        if response.status_code == 200:
-            suggestion = response.json().get("generated_text", "").strip()
-            logging.info(f"LLM suggestion generated in {elapsed_time:.2f} seconds.")
-            return suggestion
-        else:
-            logging.error(f"Error: {response.status_code}, {response.text}")
+    def embed(self, texts):
+        """Returns L2-normalized embeddings, so inner product equals cosine similarity."""
+        return self.model.encode(texts, normalize_embeddings=True, convert_to_numpy=True).astype("float32")
+
+    def lookup(self, vector):
+        """Returns the value of the most similar entry, or None if nothing clears the threshold."""
+        if self.index.ntotal == 0:
             return None
+        scores, ids = self.index.search(vector.reshape(1, -1), 1)
+        return self.values[ids[0][0]] if scores[0][0] >= self.threshold else None
+
+    def add(self, vector, value):
+        self.index.add(vector.reshape(1, -1))
+        self.values.append(value)
+
+    def match_or_add(self, keys, texts):
+        """Maps each key whose text matches an earlier entry to that entry's key; indexes the rest."""
+        matches = {}
+        for key, vector in zip(keys, self.embed(texts)):
+            match = self.lookup(vector)
+            if match is None:
+                self.add(vector, key)
+            else:
+                matches[key] = match
+        return matches
+
+def is_transient(exc):
+    """Whether a model server call failed in a way worth retrying: timeouts, dropped connections, 429 and 5xx."""
+    if isinstance(exc, httpx.HTTPStatusError):
+        return exc.response.status_code == 429 or exc.response.status_code >= 500
+    return isinstance(exc, httpx.TransportError)
+
+# Retry policy shared by every call to the model server
+retry_transient = retry(
+    stop=stop_after_attempt(3),
+    wait=wait_exponential_jitter(initial=0.5, max=8),
+    retry=retry_if_exception(is_transient),
+    reraise=True,
+)
+
+@retry_transient
+async def stream_batch(client, prompts, suggestions, received):
+    """Streams suggestions for prompts not yet in received, so a retry only resends what is missing."""
+    indices = [i for i in range(len(prompts)) if i not in received]
+    body = orjson.dumps({"prompts": [prompts[i] for i in indices], **GENERATION_SETTINGS})
+    async with client.stream("POST", REMOTE_BATCH_URL, content=body, headers=JSON_HEADERS) as response:
+        if response.status_code != 200:
+            await response.aread()
+        response.raise_for_status()
+        async for line in response.aiter_lines():
+            if not line:
+                continue
+            result = orjson.loads(line)
+            i = indices[result["index"]]
+            received.add(i)
+            suggestions[i] = strip_prompt_echo(result.get("generated_text"), prompts[i])
+
+async def get_llm_suggestions_batch(client, prompts, semaphore):
+    """Gets LLM-generated secure code fixes for a batch of prompts in a single request.
+
+    The server streams each result back as soon as it is generated, so suggestions received
+    before a failure are kept. Transient failures are retried with jittered backoff while
+    still holding the concurrency slot, so retries cannot pile onto the server.
+    """
+    suggestions = [None] * len(prompts)
+    received = set()
+    try:
+        async with semaphore:
+            start_time = time.time()
+            await stream_batch(client, prompts, suggestions, received)
+            elapsed_time = time.time() - start_time
+        logging.info(f"{len(prompts)} LLM suggestions generated in {elapsed_time:.2f} seconds.")
+    except httpx.HTTPStatusError as e:
+        logging.error(f"Error: {e.response.status_code}, {e.response.text}")
     except Exception as e:
-        logging.error(f"Error getting LLM suggestion: {e}")
-        return None
+        logging.error(f"Error getting LLM suggestions: {e}")
+    return suggestions
+
+
 
+async def print_results_async(tool_name, findings, max_concurrent=MAX_CONCURRENT_REQUESTS, cache=None,
+                              semantic_cache=None, warmup=None):
+    """Prints scan results with LLM-generated fixes.
 
+    Findings are parsed in a worker thread and consumed as they arrive; uncached ones are sent
+    to the model server in batches while parsing continues. Findings of the same rule with the same prompt share
+    a single suggestion. A pending warmup task is awaited only if prompts were sent, and cancelled otherwise.
+    """
+    parsed, prompts, suggestions, pending = [], [], [], []
+    groups = defaultdict(list)  # (test_id, prompt) -> indices of findings sharing a suggestion
+    similar_to = {}
+    requests_in_flight = []
+    semaphore = asyncio.Semaphore(max_concurrent)
 
-def print_results(tool_name, results):
-    """Prints scan results with LLM-generated fixes."""
-    if results and 'results' in results:
-        logging.info(f"\n--- {tool_name.upper()} Scan Results with LLM Suggestions ---")
-        for finding in results['results']:
-            logging.info(f"Severity: {finding.get('issue_severity', 'N/A')}")
-            logging.info(f"Issue: {finding.get('issue_text', 'N/A')}")
-            logging.info(f"File: {finding.get('filename', 'N/A')}:{finding.get('line_number', 'N/A')}")
-            suggestion = get_llm_suggestion(finding)
-            logging.info(f"Suggestion: {suggestion.strip() if suggestion else 'No suggestion available.'}\n")
-    else:
+    # One pooled keep-alive connection per concurrent batch, reused across batches
+    limits = httpx.Limits(max_keepalive_connections=max_concurrent, max_connections=max_concurrent)
+    async with httpx.AsyncClient(timeout=REMOTE_TIMEOUT, limits=limits) as client:
+        async def dispatch(batch):
+            # Only send one representative of each group of semantically equivalent findings
+            if semantic_cache:
+                matches = semantic_cache.match_or_add(batch, [prompts[i] for i in batch])
+                similar_to.update(matches)
+                batch = [i for i in batch if i not in matches]
+            if batch:
+                task = asyncio.create_task(get_llm_suggestions_batch(client, [prompts[i] for i in batch], semaphore))
+                requests_in_flight.append((batch, task))
+
+        batch = []
+        async for finding in iter_in_thread(findings):
+            i = len(parsed)
+            prompt = cache_key_prompt(finding)
+            parsed.append(finding)
+            prompts.append(prompt)
+            suggestions.append(None)
+            group = groups[(finding.get('test_id'), prompt)]
+            group.append(i)
+            if len(group) > 1:
+                continue
+            suggestions[i] = cache.get(prompt) if cache else None
+            if suggestions[i] is None:
+                pending.append(i)
+                batch.append(i)
+                if len(batch) == BATCH_SIZE:
+                    await dispatch(batch)
+                    batch = []
+        if batch:
+            await dispatch(batch)
+
+        if warmup:
+            if requests_in_flight:
+                await warmup
+            else:
+                warmup.cancel()
+        for batch, task in requests_in_flight:
+            for i, suggestion in zip(batch, await task):
+                suggestions[i] = suggestion
+    for i, match in similar_to.items():
+        suggestions[i] = suggestions[match]
+    for first, *rest in groups.values():
+        for i in rest:
+            suggestions[i] = suggestions[first]
+
+    if not parsed:
         logging.info(f"No results from {tool_name}.")
+        return
+
+    logging.info(f"{len(parsed)} findings grouped into {len(groups)} distinct prompts.")
+    if cache:
+        logging.info(f"{len(groups) - len(pending)} of {len(groups)} suggestions served from cache.")
+        # Semantic matches are approximate, so only exact generations are persisted
+        cache.set_many((prompts[i], suggestions[i]) for i in pending if suggestions[i] and i not in similar_to)
+    if semantic_cache:
+        logging.info(f"{len(similar_to)} suggestions reused from semantically similar findings.")
+
+    logging.info(f"\n--- {tool_name.upper()} Scan Results with LLM Suggestions ---")
+    for finding, suggestion in zip(parsed, suggestions):
+        suggestion = fill_location(suggestion, finding)
+        logging.info(f"Severity: {finding.get('issue_severity', 'N/A')}")
+        logging.info(f"Issue: {finding.get('issue_text', 'N/A')}")
+        logging.info(f"File: {finding.get('filename', 'N/A')}:{finding.get('line_number', 'N/A')}")
+        logging.info(f"Suggestion: {suggestion.strip() if suggestion else 'No suggestion available.'}\n")
+
+async def scan_and_report(tool_names, repo_path, output_dir, max_concurrent, cache, semantic_cache):
+    """Runs the SAST tools and prints their results, warming up the model server in the background."""
+    warmup = asyncio.create_task(warm_up_remote_model())
+    try:
+        output_files = await run_sast_tools(tool_names, repo_path, output_dir)
+        if not output_files:
+            logging.info("\nNo security findings detected.")
+            return
+        findings = itertools.chain.from_iterable(
+            iter_findings(tool_name, output_file) for tool_name, output_file in output_files
+        )
+        await print_results_async(" + ".join(tool_names), findings, max_concurrent, cache, semantic_cache, warmup)
+    finally:
+        warmup.cancel()
+
+def positive_int(value):
+    """argparse type for options that must be a positive integer."""
+    number = int(value)
+    if number < 1:
+        raise argparse.ArgumentTypeError(f"must be a positive integer, got {value}")
+    return number
 
 def main():
     parser = argparse.ArgumentParser(description="SAST Orchestrator")
     parser.add_argument("command", choices=["repo_url"], help="Command to execute (only 'repo_url' is supported)")
     parser.add_argument("repo_url", help="Git repository URL to scan")
-    parser.add_argument("-t", "--tool", choices=["bandit", "semgrep"], default="bandit", help="Choose SAST tool (default: bandit)")
+    parser.add_argument("-t", "--tool", choices=["bandit", "semgrep", "both"], default="bandit",
+                        help="Choose SAST tool, or 'both' to run them concurrently (default: bandit)")
+    parser.add_argument("-c", "--max-concurrent", type=positive_int, default=MAX_CONCURRENT_REQUESTS,
+                        help=f"Maximum concurrent LLM batch requests (default: {MAX_CONCURRENT_REQUESTS})")
+    parser.add_argument("--no-cache", action="store_true", help=f"Disable the suggestion cache at {CACHE_PATH}")
+    parser.add_argument("--semantic-cache", action="store_true",
+                        help="Reuse suggestions across semantically similar findings (needs sentence-transformers and faiss-cpu)")
     args = parser.parse_args()
 
-    with tempfile.TemporaryDirectory() as temp_dir:
-        if not clone_repo(args.repo_url, temp_dir):
-            return
+    cache = None
+    if not args.no_cache:
+        try:
+            cache = SuggestionCache()
+        except (OSError, sqlite3.Error) as e:
+            logging.warning(f"Suggestion cache unavailable, continuing without it: {e}")
 
-        output_file = os.path.join(temp_dir, "sast_results.json")
-        results = run_sast_tool(args.tool, temp_dir, output_file)
-        if results:
-            print_results(args.tool, results)
-        else:
-            logging.info("\nNo security findings detected.")
+    semantic_cache = None
+    if args.semantic_cache:
+        try:
+            semantic_cache = SemanticCache()
+        except ImportError:
+            logging.error("Semantic cache dependencies not found. Install them using: pip install sentence-transformers faiss-cpu")
+            exit(1)
+
+    try:
+        with tempfile.TemporaryDirectory() as temp_dir:
+            # Keep tool output outside the cloned tree so scanners never pick it up
+            repo_path = os.path.join(temp_dir, "repo")
+            if not clone_repo(args.repo_url, repo_path):
+                return
+
+            tool_names = ["bandit", "semgrep"] if args.tool == "both" else [args.tool]
+            asyncio.run(scan_and_report(tool_names, repo_path, temp_dir, args.max_concurrent, cache,
+                                        semantic_cache))
+    finally:
+        if cache:
+            cache.close()
 
 if __name__ == "__main__":
     main()
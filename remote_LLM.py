@@ -1,16 +1,38 @@
+import asyncio
 import logging
+import os
+from collections import OrderedDict
 from fastapi import FastAPI, HTTPException
+from fastapi.responses import ORJSONResponse, StreamingResponse
 from pydantic import BaseModel
 import uvicorn
 import sys
+import time
 from datetime import datetime
-import requests
+import httpx
+import orjson
+from tenacity import retry, retry_if_exception, stop_after_attempt, wait_exponential_jitter
+
+DEFAULT_MODEL = "llama2"
+OLLAMA_KEEP_ALIVE = -1  # Keep models loaded indefinitely instead of unloading when idle
 
 
 class GenerateRequest(BaseModel):
     prompt: str
-    model: str = "llama2"  # Default model
-    max_length: int = 750
+    model: str = DEFAULT_MODEL
+    max_length: int = 200  # Prompts ask for under 100 words
+    temperature: float = 0.7
+    stream: bool = False  # Stream the text back as it is generated
+
+
+class GenerateBatchRequest(BaseModel):
+    """Prompts generated concurrently, up to OLLAMA_NUM_PARALLEL at a time per worker process.
+
+    Ollama enforces its own OLLAMA_NUM_PARALLEL across all workers and queues the rest.
+    """
+    prompts: list[str]
+    model: str = DEFAULT_MODEL
+    max_length: int = 200  # Prompts ask for under 100 words
     temperature: float = 0.7
 
 
@@ -25,51 +47,184 @@ logging.basicConfig(
 
 logger = logging.getLogger(__name__)  # Get a logger for this module
 
-app = FastAPI(debug=True)
+app = FastAPI(debug=True, default_response_class=ORJSONResponse)
 
 # Ollama API endpoint - updated to 192.168.1.13:11434
 OLLAMA_API_URL = "http://192.168.1.13:11434/api/generate"
+OLLAMA_TAGS_URL = "http://192.168.1.13:11434/api/tags"
 OLLAMA_TIMEOUT = 300  # Adjust based on your needs
+JSON_HEADERS = {"Content-Type": "application/json"}
+WEB_CONCURRENCY = int(os.getenv("WEB_CONCURRENCY", "4"))  # Uvicorn worker processes
+# Ollama has no native batch API, so batches fan out to concurrent calls. This caps the
+# fan-out per worker process; the server-wide limit is Ollama's own OLLAMA_NUM_PARALLEL,
+# which queues any excess requests rather than running them.
+OLLAMA_NUM_PARALLEL = int(os.getenv("OLLAMA_NUM_PARALLEL", "4"))
+ollama_semaphore = asyncio.Semaphore(OLLAMA_NUM_PARALLEL)
+
+# Shared keep-alive client for Ollama calls, created on startup and closed on shutdown
+http_client = None
+
+# In-memory LRU of generated text keyed by (model, prompt, temperature, max_length)
+RESPONSE_CACHE_SIZE = 4096
+response_cache = OrderedDict()
+
+
+def cache_get(key):
+    """Return the cached response for key, marking it most recently used."""
+    if key not in response_cache:
+        return None
+    response_cache.move_to_end(key)
+    return response_cache[key]
+
+
+def cache_put(key, value):
+    """Store a response, evicting the least recently used entry when full."""
+    response_cache[key] = value
+    response_cache.move_to_end(key)
+    if len(response_cache) > RESPONSE_CACHE_SIZE:
+        response_cache.popitem(last=False)
+
+
+def cache_key(prompt, request):
+    """Build the response cache key from a prompt and its generation settings."""
+    return (request.model, prompt, request.temperature, request.max_length)
+
+
+def is_transient(exc):
+    """Whether an Ollama call failed in a way worth retrying: timeouts, dropped connections, 429 and 5xx."""
+    if isinstance(exc, httpx.HTTPStatusError):
+        return exc.response.status_code == 429 or exc.response.status_code >= 500
+    return isinstance(exc, httpx.TransportError)
 
 
+# Retry policy shared by every call to Ollama
+retry_transient = retry(
+    stop=stop_after_attempt(3),
+    wait=wait_exponential_jitter(initial=0.5, max=8),
+    retry=retry_if_exception(is_transient),
+    reraise=True,
+)
+
+
+@retry_transient
+async def post_to_ollama(payload):
+    """POST a generation payload to Ollama under the shared concurrency cap, retrying transient failures."""
+    body = orjson.dumps(payload)
+    async with ollama_semaphore:
+        response = await http_client.post(OLLAMA_API_URL, content=body, headers=JSON_HEADERS)
+    response.raise_for_status()
+    return response
+
+
+@retry_transient
+async def open_ollama_stream(payload):
+    """Open a streaming generation request to Ollama, retrying transient failures."""
+    response = await http_client.send(
+        http_client.build_request("POST", OLLAMA_API_URL, content=orjson.dumps(payload), headers=JSON_HEADERS),
+        stream=True,
+    )
+    if response.status_code != 200:
+        await response.aread()
+        await response.aclose()
+        response.raise_for_status()
+    return response
+
+
+def build_ollama_payload(prompt, request):
+    """Build the Ollama /api/generate payload for a prompt and its generation settings."""
+    return {
+        "prompt": prompt,
+        "model": request.model,
+        "stream": False,
+        "keep_alive": OLLAMA_KEEP_ALIVE,
+        "options": {
+            "temperature": request.temperature,
+            "num_predict": request.max_length,
+        }
+    }
+
 
 @app.get("/")
 def hello() -> str:
     return "hello"
 
 
+async def stream_tokens(payload, prompt, request):
+    """Yield the prompt and then each token Ollama streams back, caching the full text.
+
+    A slot of the Ollama concurrency cap is held for as long as the generation runs.
+    """
+    async with ollama_semaphore:
+        response = await open_ollama_stream(payload)
+        chunks = [prompt]
+        try:
+            yield prompt
+            async for line in response.aiter_lines():
+                if not line:
+                    continue
+                chunk = orjson.loads(line)
+                token = chunk.get("response", "")
+                chunks.append(token)
+                yield token
+                if chunk.get("done"):
+                    generated_text = "".join(chunks)
+                    logger.info(f"Streamed response of length {len(generated_text) - len(prompt)}")
+                    cache_put(cache_key(prompt, request), generated_text)
+                    break
+        finally:
+            await response.aclose()
+
+
+async def prepend(first, rest):
+    """Yield first, then everything left in the async iterator rest."""
+    yield first
+    async for item in rest:
+        yield item
+
+
 @app.post("/generate")
 async def generate_text(request: GenerateRequest):
-    """Generate text using Ollama LLM."""
+    """Generate text using Ollama LLM, optionally streaming it token by token."""
     prompt = request.prompt
     logger.info(f"Received prompt: {prompt[:100]}...")  # Log first 100 chars
 
+    cached = cache_get(cache_key(prompt, request))
+    if cached is not None:
+        logger.info("Serving response from cache")
+        if request.stream:
+            return StreamingResponse(iter([cached]), media_type="text/plain")
+        return {"generated_text": cached}
+
     try:
         # Create the request payload for Ollama
-        ollama_payload = {
-            "prompt": prompt,
-            "model": request.model,
-            "options": {
-                "temperature": request.temperature,
-                "num_predict": request.max_length,
-            }
-        }
+        ollama_payload = build_ollama_payload(prompt, request)
 
-        # Make the request to Ollama
-        response = requests.post(OLLAMA_API_URL, json=ollama_payload, timeout=OLLAMA_TIMEOUT)
+        if request.stream:
+            ollama_payload["stream"] = True
+            tokens = stream_tokens(ollama_payload, prompt, request)
+            # Pull the first item here so Ollama errors surface as HTTP errors, not a broken stream
+            first = await tokens.__anext__()
+            return StreamingResponse(prepend(first, tokens), media_type="text/plain")
 
-        if response.status_code != 200:
-            logger.error(f"Ollama API error: {response.status_code} - {response.text}")
-            raise HTTPException(status_code=500, detail="Error communicating with Ollama API")
+        # Make the request to Ollama
+        response = await post_to_ollama(ollama_payload)
 
         # Extract the generated text from Ollama's response
-        response_data = response.json()
+        response_data = orjson.loads(response.content)
         generated_text = response_data.get("response", "")
 
         logger.info(f"Generated response of length {len(generated_text)}")
+        cache_put(cache_key(prompt, request), prompt + generated_text)
         return {"generated_text": prompt + generated_text}
 
-    except requests.RequestException as e:
+    except HTTPException:
+        raise
+
+    except httpx.HTTPStatusError as e:
+        logger.error(f"Ollama API error: {e.response.status_code} - {e.response.text}")
+        raise HTTPException(status_code=500, detail="Error communicating with Ollama API")
+
+    except httpx.RequestError as e:
         logger.error(f"Error connecting to Ollama: {str(e)}")
         raise HTTPException(status_code=503, detail="Ollama service unavailable")
 
@@ -78,26 +233,145 @@ async def generate_text(request: GenerateRequest):
         raise HTTPException(status_code=500, detail=f"Internal server error: {str(e)}")
 
 
+async def generate_one(prompt, request):
+    """Generate text for a single prompt of a batch, returning None if Ollama fails."""
+    key = cache_key(prompt, request)
+    cached = cache_get(key)
+    if cached is not None:
+        return cached
+
+    try:
+        response = await post_to_ollama(build_ollama_payload(prompt, request))
+        generated_text = prompt + orjson.loads(response.content).get("response", "")
+        cache_put(key, generated_text)
+        return generated_text
+
+    except httpx.HTTPStatusError as e:
+        logger.error(f"Ollama API error: {e.response.status_code} - {e.response.text}")
+        return None
+
+    except httpx.RequestError as e:
+        logger.error(f"Error connecting to Ollama: {str(e)}")
+        return None
+
+    except orjson.JSONDecodeError as e:
+        logger.error(f"Invalid JSON from Ollama: {str(e)}")
+        return None
+
+    except Exception as e:
+        # One bad prompt must not end the NDJSON stream and take the rest of the batch with it
+        logger.error(f"Unexpected error in generate_one: {str(e)}")
+        return None
+
+
+@app.post("/generate_batch")
+async def generate_batch(request: GenerateBatchRequest):
+    """Generate text for several prompts in one call, fanning out to Ollama concurrently.
+
+    Results are streamed back as newline-delimited JSON objects ({"index", "generated_text"})
+    in completion order, so callers can use each one as soon as it is ready.
+    """
+    logger.info(f"Received batch of {len(request.prompts)} prompts")
+
+    async def generate_indexed(index, prompt):
+        return index, await generate_one(prompt, request)
+
+    async def stream_results():
+        tasks = [asyncio.create_task(generate_indexed(i, prompt)) for i, prompt in enumerate(request.prompts)]
+        failed = 0
+        try:
+            for next_result in asyncio.as_completed(tasks):
+                index, generated_text = await next_result
+                failed += generated_text is None
+                yield orjson.dumps({"index": index, "generated_text": generated_text}) + b"\n"
+            logger.info(f"Generated {len(tasks) - failed} responses ({failed} failed)")
+        finally:
+            # Stop outstanding generations if the client goes away mid-stream
+            for task in tasks:
+                task.cancel()
+
+    return StreamingResponse(stream_results(), media_type="application/x-ndjson")
+
+
+async def warm_up_model(model=DEFAULT_MODEL):
+    """Load a model into Ollama ahead of the first real request by generating a single token."""
+    start_time = time.time()
+    try:
+        response = await http_client.post(
+            OLLAMA_API_URL,
+            json={
+                "model": model,
+                "prompt": " ",
+                "stream": False,
+                "keep_alive": OLLAMA_KEEP_ALIVE,
+                "options": {"num_predict": 1},
+            },
+            timeout=60,
+        )
+        if response.status_code == 200:
+            elapsed_time = time.time() - start_time
+            logger.info(f"Model {model} loaded in {elapsed_time:.2f} seconds")
+            return True
+        logger.warning(f"Could not warm up model {model}: {response.status_code} - {response.text}")
+    except httpx.RequestError as e:
+        logger.warning(f"Could not warm up model {model}: {str(e)}")
+    return False
+
+
+@app.post("/warmup")
+async def warmup(model: str = DEFAULT_MODEL):
+    """Load a model into Ollama so the next generation skips the cold start."""
+    if not await warm_up_model(model):
+        raise HTTPException(status_code=503, detail=f"Could not load model {model}")
+    return {"model": model, "loaded": True}
+
+
 # Log startup information
 @app.on_event("startup")
 async def startup_event():
+    global http_client
     logger.info(f"Starting up application at {datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S')} UTC")
     logger.info(f"User: {sys.argv[0] if len(sys.argv) > 0 else 'unknown'}")
 
+    http_client = httpx.AsyncClient(
+        limits=httpx.Limits(max_keepalive_connections=32, max_connections=100),
+        timeout=OLLAMA_TIMEOUT,
+    )
+
     # Check if Ollama is available
     try:
         # Test connection to Ollama
-        models_response = requests.get("http://192.168.1.13:11434/api/tags")
+        models_response = await http_client.get(OLLAMA_TAGS_URL)
         if models_response.status_code == 200:
             models = models_response.json().get("models", [])
             logger.info(f"Connected to Ollama. Available models: {[m.get('name') for m in models]}")
+            await warm_up_model()
         else:
             logger.warning(f"Ollama responded with status code {models_response.status_code}")
-    except requests.RequestException as e:
+    except httpx.RequestError as e:
         logger.warning(f"Could not connect to Ollama: {str(e)}")
         logger.warning("Make sure Ollama is running on 192.168.1.13:11434")
 
 
+@app.on_event("shutdown")
+async def shutdown_event():
+    if http_client is not None:
+        await http_client.aclose()
+    logger.info("Closed Ollama HTTP client")
+
+
 if __name__ == "__main__":
-    # Configure uvicorn to use the same logging configuration
-    uvicorn.run(app, host="192.168.1.13", port=9000, log_level="info")
+    # Configure uvicorn to use the same logging configuration. Multiple workers need the
+    # app as an import string; each worker keeps its own Ollama client and response cache.
+    uvicorn.run(
+        "remote_LLM:app",
+        host="192.168.1.13",
+        port=9000,
+        log_level="info",
+        workers=WEB_CONCURRENCY,
+        loop="uvloop",
+        http="httptools",
+        # Hold client connections open across batches and absorb bursts of concurrent connects
+        timeout_keep_alive=75,
+        backlog=2048,
+    )
@@ -1,6 +1,6 @@
 import os
 import logging
-from transformers import pipeline
+import shutil
 
 # Configure logging
 logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
@@ -9,25 +9,25 @@ models_path = os.path.expanduser("~/.cache/huggingface/hub")
 
 def list_models():
     """Lists available models in the Hugging Face cache directory."""
-    if os.path.exists(models_path):
-        models = [f for f in os.listdir(models_path) if os.path.isdir(os.path.join(models_path, f))]
-        logging.info(f"Available models: {models}")
-        return models
-    logging.info("No cached models found.")
-    return []
+    try:
+        with os.scandir(models_path) as entries:
+            models = [entry.name for entry in entries if entry.is_dir(follow_symlinks=False)]
+    except FileNotFoundError:
+        logging.info("No cached models found.")
+        return []
+    logging.info(f"Available models: {models}")
+    return models
 
 def delete_model(model_name):
     """Deletes a specific cached model by name."""
     model_path = os.path.join(models_path, model_name)
-    if os.path.exists(model_path):
-        try:
-            import shutil
-            shutil.rmtree(model_path)
-            logging.info(f"Deleted model: {model_name}")
-        except Exception as e:
-            logging.error(f"Error deleting model: {e}")
-    else:
+    try:
+        shutil.rmtree(model_path)
+        logging.info(f"Deleted model: {model_name}")
+    except FileNotFoundError:
         logging.warning(f"Model '{model_name}' not found.")
+    except Exception as e:
+        logging.error(f"Error deleting model: {e}")
 
 # List available models before loading
 available_models = list_models()